@@ -13,7 +13,7 @@ SEND_TIME_TMPL = "Sending took %.1fs, code=%s\n"
 
 
 def notify(flip_id, stdout):
-    flip = Flip.objects.get(id=flip_id)
+    flip = Flip.objects.select_related("owner__project").get(id=flip_id)
 
     check = flip.owner
     # Set the historic status here but *don't save it*.
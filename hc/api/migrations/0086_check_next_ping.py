@@ -0,0 +1,18 @@
+# Generated by Django 4.0.3 on 2022-03-04 10:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0085_ping_object_size'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='check',
+            name='next_ping',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.0.3 on 2022-03-04 11:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0086_check_next_ping'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='flip',
+            index=models.Index(fields=['owner', '-created'], name='api_flip_owner_created'),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 4.0.3 on 2022-03-04 11:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0087_flip_owner_created'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='ping',
+            index=models.Index(fields=['owner', 'n'], name='api_ping_owner_n'),
+        ),
+        migrations.AddIndex(
+            model_name='ping',
+            index=models.Index(fields=['owner', 'id'], name='api_ping_owner_id'),
+        ),
+    ]
@@ -1,23 +1,28 @@
 # coding: utf-8
 
 import hashlib
+import heapq
 import json
+import re
 import time
 import uuid
 from datetime import datetime, timedelta as td, timezone
+from functools import cached_property, lru_cache, partial
 
 from cronsim import CronSim
 from django.conf import settings
 from django.core.signing import TimestampSigner
-from django.db import models
-from django.urls import reverse
+from django.db import connection, models, transaction
+from django.db.models import Subquery
+from django.urls import get_script_prefix, get_urlconf, reverse
 from django.utils.timezone import now
 from django.utils.text import slugify
 from hc.accounts.models import Project
 from hc.api import transports
 from hc.lib import emails
 from hc.lib.date import month_boundaries
-from hc.lib.s3 import get_object, put_object, remove_objects
+from hc.lib.redis import RedisError, add_key, take_token
+from hc.lib.s3 import get_object, put_object_async, remove_objects
 
 try:
     from zoneinfo import ZoneInfo
@@ -63,14 +68,78 @@ CHANNEL_KINDS = (
     ("signal", "Signal"),
 )
 
+TRANSPORTS = {
+    "email": transports.Email,
+    "webhook": transports.Webhook,
+    "slack": transports.Slack,
+    "mattermost": transports.Slack,
+    "hipchat": transports.HipChat,
+    "pd": transports.PagerDuty,
+    "pagertree": transports.PagerTree,
+    "pagerteam": transports.PagerTeam,
+    "victorops": transports.VictorOps,
+    "pushbullet": transports.Pushbullet,
+    "po": transports.Pushover,
+    "opsgenie": transports.Opsgenie,
+    "discord": transports.Discord,
+    "telegram": transports.Telegram,
+    "sms": transports.Sms,
+    "trello": transports.Trello,
+    "matrix": transports.Matrix,
+    "whatsapp": transports.WhatsApp,
+    "apprise": transports.Apprise,
+    "msteams": transports.MsTeams,
+    "shell": transports.Shell,
+    "zulip": transports.Zulip,
+    "spike": transports.Spike,
+    "call": transports.Call,
+    "linenotify": transports.LineNotify,
+    "signal": transports.Signal,
+}
+
 PO_PRIORITIES = {-2: "lowest", -1: "low", 0: "normal", 1: "high", 2: "emergency"}
 
+# Check fields that Check.ping() reads and updates
+PING_STATE_FIELDS = (
+    "last_start",
+    "last_ping",
+    "last_duration",
+    "status",
+    "alert_after",
+    "n_pings",
+    "has_confirmation_link",
+)
+# Used in Check.ping() to look for confirmation links in ping bodies
+CONFIRM_RE = re.compile(rb"confirm", re.IGNORECASE)
+
+
+@lru_cache(maxsize=None)
+def _path_template(name, placeholder, urlconf):
+    path = reverse(name, args=[placeholder], urlconf=urlconf)
+    # Cache the path without the script prefix. The prefix is set per
+    # thread, so reverse_code adds the current one on every call.
+    return path[len(get_script_prefix()) :]
+
+
+def reverse_code(name, code, placeholder=str(uuid.UUID(int=0))):
+    """ Same as reverse(name, args=[code]) but faster in loops.
+
+    reverse() walks the URL resolver on every call. The URLs of checks and
+    channels only differ by the code, so resolve each URL once, with a
+    placeholder argument, and then substitute the actual code.
+
+    """
+
+    urlconf = get_urlconf() or settings.ROOT_URLCONF
+    template = _path_template(name, placeholder, urlconf)
+    return get_script_prefix() + template.replace(placeholder, str(code))
+
 
 def isostring(dt):
     """Convert the datetime to ISO 8601 format with no microseconds. """
 
     if dt:
-        return dt.replace(microsecond=0).isoformat()
+        return dt.isoformat(timespec="seconds")
 
 
 class Check(models.Model):
@@ -98,6 +167,9 @@ class Check(models.Model):
     last_ping_was_fail = models.BooleanField(default=False)
     has_confirmation_link = models.BooleanField(default=False)
     alert_after = models.DateTimeField(null=True, blank=True, editable=False)
+    # For cron checks, the next expected ping time, precomputed on save()
+    # from schedule, tz and last_ping. See cron_next_ping().
+    next_ping = models.DateTimeField(null=True, blank=True, editable=False)
     status = models.CharField(max_length=6, choices=STATUSES, default="new")
 
     class Meta:
@@ -115,6 +187,27 @@ class Check(models.Model):
     def __str__(self):
         return "%s (%d)" % (self.name or self.code, self.id)
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+
+        # Seed the cron_next_ping() memo with the precomputed value, so
+        # loaded cron checks don't need to run CronSim at all.
+        fields = ("schedule", "tz", "last_ping", "next_ping")
+        if instance.get_deferred_fields().isdisjoint(fields) and instance.next_ping:
+            key = (instance.schedule, instance.tz, instance.last_ping)
+            instance._cron_next_ping = (key, instance.next_ping)
+
+        return instance
+
+    def save(self, *args, **kwargs):
+        if self.kind == "cron" and self.last_ping:
+            self.next_ping = self.cron_next_ping()
+        else:
+            self.next_ping = None
+
+        super().save(*args, **kwargs)
+
     def name_then_code(self):
         if self.name:
             return self.name
@@ -140,10 +233,11 @@ class Check(models.Model):
         return settings.PING_ENDPOINT + str(self.code)
 
     def details_url(self):
-        return settings.SITE_ROOT + reverse("hc-details", args=[self.code])
+        return settings.SITE_ROOT + reverse_code("hc-details", self.code)
 
     def cloaked_url(self):
-        return settings.SITE_ROOT + reverse("hc-uncloak", args=[self.unique_key])
+        path = reverse_code("hc-uncloak", self.unique_key, placeholder="0" * 40)
+        return settings.SITE_ROOT + path
 
     def email(self):
         return "%s@%s" % (self.code, settings.PING_EMAIL_DOMAIN)
@@ -153,9 +247,36 @@ class Check(models.Model):
             return self.last_duration
 
     def set_name_slug(self, name):
+        # slugify() does Unicode normalization and several regex passes,
+        # skip it if the name has not changed and already has a slug
+        if name == self.name and (self.slug or not name):
+            return
+
         self.name = name
         self.slug = slugify(name)
 
+    def cron_next_ping(self):
+        """ Return the next expected ping time based on cron schedule.
+
+        The result is memoized on the instance, keyed by the fields it
+        depends on. This way get_status(), to_dict() and going_down_after()
+        can call it repeatedly and only run CronSim once.
+
+        """
+
+        key = (self.schedule, self.tz, self.last_ping)
+        cached = getattr(self, "_cron_next_ping", None)
+        if cached and cached[0] == key:
+            return cached[1]
+
+        # The complex case, next ping is expected based on cron schedule.
+        # Don't convert to naive datetimes (and so avoid ambiguities around
+        # DST transitions). cronsim will handle the timezone-aware datetimes.
+        last_local = self.last_ping.astimezone(ZoneInfo(self.tz))
+        result = next(CronSim(self.schedule, last_local))
+        self._cron_next_ping = (key, result)
+        return result
+
     def get_grace_start(self, with_started=True):
         """ Return the datetime when the grace period starts.
 
@@ -170,11 +291,7 @@ class Check(models.Model):
         if self.kind == "simple" and self.status == "up":
             result = self.last_ping + self.timeout
         elif self.kind == "cron" and self.status == "up":
-            # The complex case, next ping is expected based on cron schedule.
-            # Don't convert to naive datetimes (and so avoid ambiguities around
-            # DST transitions). cronsim will handle the timezone-aware datetimes.
-            last_local = self.last_ping.astimezone(ZoneInfo(self.tz))
-            result = next(CronSim(self.schedule, last_local))
+            result = self.cron_next_ping()
 
         if with_started and self.last_start and self.status != "down":
             result = min(result, self.last_start)
@@ -219,11 +336,29 @@ class Check(models.Model):
         return "up"
 
     def assign_all_channels(self):
-        channels = Channel.objects.filter(project=self.project)
-        self.channel_set.set(channels)
+        # Insert the M2M rows directly, without loading Channel objects.
+        # Clear existing assignments first: the check may have been moved
+        # from another project, and still be assigned its channels.
+        Through = Channel.checks.through
+        q = Channel.objects.filter(project_id=self.project_id)
+        ids = q.values_list("id", flat=True)
+        rows = [Through(channel_id=cid, check_id=self.id) for cid in ids]
+
+        # Replace the assignments in a single transaction, so other
+        # connections never see the check with no channels
+        with transaction.atomic():
+            Through.objects.filter(check_id=self.id).delete()
+            Through.objects.bulk_create(rows, batch_size=1000)
 
     def tags_list(self):
-        return [t.strip() for t in self.tags.split(" ") if t.strip()]
+        # Memoize the result, as views and templates call this repeatedly.
+        # Split again only if self.tags gets reassigned. Return a copy,
+        # so callers can modify the list without corrupting the memo.
+        cached = getattr(self, "_tags_list", None)
+        if cached is None or cached[0] is not self.tags:
+            self._tags_list = (self.tags, self.tags.split())
+
+        return list(self._tags_list[1])
 
     def matches_tag_set(self, tag_set):
         return tag_set.issubset(self.tags_list())
@@ -236,8 +371,10 @@ class Check(models.Model):
         codes = [str(channel.code) for channel in self.channel_set.all()]
         return ",".join(sorted(codes))
 
-    @property
+    @cached_property
     def unique_key(self):
+        # self.code never changes after the check is created,
+        # so it is safe to compute the hash only once per instance
         code_half = self.code.hex[:16]
         return hashlib.sha1(code_half.encode()).hexdigest()
 
@@ -263,12 +400,13 @@ class Check(models.Model):
         if readonly:
             result["unique_key"] = self.unique_key
         else:
-            update_rel_url = reverse("hc-api-single", args=[self.code])
-            pause_rel_url = reverse("hc-api-pause", args=[self.code])
+            code, site_root = str(self.code), settings.SITE_ROOT
+            update_rel_url = reverse_code("hc-api-single", code)
+            pause_rel_url = reverse_code("hc-api-pause", code)
 
-            result["ping_url"] = settings.PING_ENDPOINT + str(self.code)
-            result["update_url"] = settings.SITE_ROOT + update_rel_url
-            result["pause_url"] = settings.SITE_ROOT + pause_rel_url
+            result["ping_url"] = settings.PING_ENDPOINT + code
+            result["update_url"] = site_root + update_rel_url
+            result["pause_url"] = site_root + pause_rel_url
             result["channels"] = self.channels_str()
 
         if self.kind == "simple":
@@ -282,56 +420,70 @@ class Check(models.Model):
     def ping(self, remote_addr, scheme, method, ua, body, action, exitstatus=None):
         frozen_now = now()
 
-        if self.status == "paused" and self.manual_resume:
-            action = "ign"
-
-        if action == "start":
-            self.last_start = frozen_now
-            # Don't update "last_ping" field.
-        elif action == "ign":
-            pass
-        else:
-            self.last_ping = frozen_now
-            if self.last_start:
-                self.last_duration = self.last_ping - self.last_start
-                self.last_start = None
+        with transaction.atomic():
+            # Lock the check's row, and pick up any changes made by concurrent
+            # pings. This way pings to the same check get processed one at a
+            # time, and don't race on status and n_pings.
+            locked = Check.objects.select_for_update().get(id=self.id)
+            for field in PING_STATE_FIELDS:
+                setattr(self, field, getattr(locked, field))
+
+            if self.status == "paused" and self.manual_resume:
+                action = "ign"
+
+            if action == "start":
+                self.last_start = frozen_now
+                # Don't update "last_ping" field.
+            elif action == "ign":
+                pass
             else:
-                self.last_duration = None
-
-            new_status = "down" if action == "fail" else "up"
-            if self.status != new_status:
-                flip = Flip(owner=self)
-                flip.created = self.last_ping
-                flip.old_status = self.status
-                flip.new_status = new_status
-                flip.save()
+                self.last_ping = frozen_now
+                if self.last_start:
+                    self.last_duration = self.last_ping - self.last_start
+                    self.last_start = None
+                else:
+                    self.last_duration = None
+
+                new_status = "down" if action == "fail" else "up"
+                if self.status != new_status:
+                    flip = Flip(owner=self)
+                    flip.created = self.last_ping
+                    flip.old_status = self.status
+                    flip.new_status = new_status
+                    flip.save()
+
+                    self.status = new_status
+
+            self.alert_after = self.going_down_after()
+            # The row is locked, so a plain increment is safe here
+            self.n_pings += 1
+            self.has_confirmation_link = CONFIRM_RE.search(body) is not None
+            self.save(update_fields=PING_STATE_FIELDS + ("next_ping",))
+
+            ping = Ping(owner=self)
+            ping.n = self.n_pings
+            ping.created = frozen_now
+            if action in ("start", "fail", "ign"):
+                ping.kind = action
+
+            ping.remote_addr = remote_addr
+            ping.scheme = scheme
+            ping.method = method
+            # If User-Agent is longer than 200 characters, truncate it:
+            ping.ua = ua[:200]
+            if len(body) > 100 and settings.S3_BUCKET:
+                ping.object_size = len(body)
+            else:
+                ping.body_raw = body
+            ping.exitstatus = exitstatus
+            ping.save()
 
-                self.status = new_status
-
-        self.alert_after = self.going_down_after()
-        self.n_pings = models.F("n_pings") + 1
-        self.has_confirmation_link = "confirm" in body.decode(errors="replace").lower()
-        self.save()
-        self.refresh_from_db()
-
-        ping = Ping(owner=self)
-        ping.n = self.n_pings
-        ping.created = frozen_now
-        if action in ("start", "fail", "ign"):
-            ping.kind = action
-
-        ping.remote_addr = remote_addr
-        ping.scheme = scheme
-        ping.method = method
-        # If User-Agent is longer than 200 characters, truncate it:
-        ping.ua = ua[:200]
-        if len(body) > 100 and settings.S3_BUCKET:
-            ping.object_size = len(body)
-            put_object(self.code, ping.n, body)
-        else:
-            ping.body_raw = body
-        ping.exitstatus = exitstatus
-        ping.save()
+            if ping.object_size:
+                # Upload the body on a background thread, so the client does not
+                # have to wait for it. If the upload fails, store it in the database.
+                fallback = partial(ping.save_body_raw, body)
+                upload = partial(put_object_async, self.code, ping.n, body, fallback)
+                transaction.on_commit(upload)
 
         # Every 100 received pings, prune old pings and notifications:
         if self.n_pings % 100 == 0:
@@ -341,6 +493,9 @@ class Check(models.Model):
         """ Remove old pings and notifications. """
 
         threshold = self.n_pings - self.project.owner_profile.ping_log_limit
+        if threshold <= 0:
+            # The check has not received enough pings yet, nothing to prune
+            return
 
         # Remove ping bodies from object storage
         if settings.S3_BUCKET:
@@ -349,11 +504,10 @@ class Check(models.Model):
         # Remove ping objects from db
         self.ping_set.filter(n__lte=threshold).delete()
 
-        try:
-            ping = self.ping_set.earliest("id")
-            self.notification_set.filter(created__lt=ping.created).delete()
-        except Ping.DoesNotExist:
-            pass
+        # Remove notifications older than the earliest remaining ping,
+        # in a single DELETE statement with a subquery
+        earliest = self.ping_set.order_by("id").values("created")[:1]
+        self.notification_set.filter(created__lt=Subquery(earliest)).delete()
 
     def downtimes(self, months):
         """ Calculate the number of downtimes and downtime minutes per month.
@@ -372,16 +526,19 @@ class Check(models.Model):
         # (year, month) -> [datetime, total_downtime, number_of_outages]
         totals = {monthkey(b): [b, td(), 0] for b in boundaries}
 
-        # A list of flips and month boundaries
-        events = [(b, "---") for b in boundaries]
+        # Flips and month boundaries, both in descending order. Let the
+        # database sort the flips, then merge the two sequences in a single
+        # pass instead of collecting and sorting everything in Python.
         q = self.flip_set.filter(created__gt=min(boundaries))
-        for pair in q.values_list("created", "old_status"):
-            events.append(pair)
+        q = q.order_by("-created", "-old_status")
+        flips = q.values_list("created", "old_status")
+        markers = [(b, "---") for b in reversed(boundaries)]
+        events = heapq.merge(flips, markers, reverse=True)
 
         # Iterate through flips and month boundaries in reverse order,
         # and for each "down" event increase the counters in `totals`.
         dt, status = now(), self.status
-        for prev_dt, prev_status in sorted(events, reverse=True):
+        for prev_dt, prev_status in events:
             if status == "down":
                 delta = dt - prev_dt
                 totals[monthkey(prev_dt)][1] += delta
@@ -420,6 +577,16 @@ class Ping(models.Model):
     object_size = models.IntegerField(null=True)
     exitstatus = models.SmallIntegerField(null=True)
 
+    class Meta:
+        indexes = [
+            # For looking up check's pings by n.
+            # Used in Check.prune() and in the ping details views.
+            models.Index(fields=["owner", "n"], name="api_ping_owner_n"),
+            # For looking up check's most recent or earliest pings.
+            # Used in Check.prune() and in the ping log views.
+            models.Index(fields=["owner", "id"], name="api_ping_owner_id"),
+        ]
+
     def to_dict(self):
         return {
             "type": self.kind or "success",
@@ -431,6 +598,12 @@ class Ping(models.Model):
             "ua": self.ua,
         }
 
+    def save_body_raw(self, body):
+        """ Store the body in the database instead of object storage. """
+
+        self.body_raw, self.object_size = body, None
+        Ping.objects.filter(id=self.id).update(body_raw=body, object_size=None)
+
     def has_body(self):
         if self.body or self.body_raw or self.object_size:
             return True
@@ -487,8 +660,12 @@ class Channel(models.Model):
         return self.kind in ("email", "webhook", "sms", "signal", "whatsapp")
 
     def assign_all_checks(self):
-        checks = Check.objects.filter(project=self.project)
-        self.checks.add(*checks)
+        # Insert the M2M rows directly, without loading Check objects.
+        Through = Channel.checks.through
+        q = Check.objects.filter(project_id=self.project_id)
+        ids = q.values_list("id", flat=True)
+        rows = [Through(channel_id=self.id, check_id=cid) for cid in ids]
+        Through.objects.bulk_create(rows, batch_size=1000, ignore_conflicts=True)
 
     def make_token(self):
         seed = "%s%s" % (self.code, settings.SECRET_KEY)
@@ -510,62 +687,19 @@ class Channel(models.Model):
 
     @property
     def transport(self):
-        if self.kind == "email":
-            return transports.Email(self)
-        elif self.kind == "webhook":
-            return transports.Webhook(self)
-        elif self.kind in ("slack", "mattermost"):
-            return transports.Slack(self)
-        elif self.kind == "hipchat":
-            return transports.HipChat(self)
-        elif self.kind == "pd":
-            return transports.PagerDuty(self)
-        elif self.kind == "pagertree":
-            return transports.PagerTree(self)
-        elif self.kind == "pagerteam":
-            return transports.PagerTeam(self)
-        elif self.kind == "victorops":
-            return transports.VictorOps(self)
-        elif self.kind == "pushbullet":
-            return transports.Pushbullet(self)
-        elif self.kind == "po":
-            return transports.Pushover(self)
-        elif self.kind == "opsgenie":
-            return transports.Opsgenie(self)
-        elif self.kind == "discord":
-            return transports.Discord(self)
-        elif self.kind == "telegram":
-            return transports.Telegram(self)
-        elif self.kind == "sms":
-            return transports.Sms(self)
-        elif self.kind == "trello":
-            return transports.Trello(self)
-        elif self.kind == "matrix":
-            return transports.Matrix(self)
-        elif self.kind == "whatsapp":
-            return transports.WhatsApp(self)
-        elif self.kind == "apprise":
-            return transports.Apprise(self)
-        elif self.kind == "msteams":
-            return transports.MsTeams(self)
-        elif self.kind == "shell":
-            return transports.Shell(self)
-        elif self.kind == "zulip":
-            return transports.Zulip(self)
-        elif self.kind == "spike":
-            return transports.Spike(self)
-        elif self.kind == "call":
-            return transports.Call(self)
-        elif self.kind == "linenotify":
-            return transports.LineNotify(self)
-        elif self.kind == "signal":
-            return transports.Signal(self)
-        else:
+        if self.kind not in TRANSPORTS:
             raise NotImplementedError("Unknown channel kind: %s" % self.kind)
 
-    def notify(self, check, is_test=False):
-        if self.transport.is_noop(check):
-            return "no-op"
+        return TRANSPORTS[self.kind](self)
+
+    def deliver(self, check, is_test=False):
+        """ Create a Notification and send it using this channel's transport.
+
+        Return the Notification with its `error` field set to the outcome.
+        Also set this channel's last_notify, last_error and disabled fields
+        accordingly. The caller is responsible for saving both.
+
+        """
 
         n = Notification(channel=self)
         if is_test:
@@ -586,19 +720,47 @@ class Channel(models.Model):
             disabled = True if e.permanent else disabled
             error = e.message
 
-        Notification.objects.filter(id=n.id).update(error=error)
+        n.error = error
+        self.last_notify, self.last_error, self.disabled = now(), error, disabled
+        return n
+
+    def notify(self, check, is_test=False):
+        if self.transport.is_noop(check):
+            return "no-op"
+
+        n = self.deliver(check, is_test=is_test)
+        Notification.objects.filter(id=n.id).update(error=n.error)
+        self.save_delivery_status()
+
+        return n.error
+
+    def save_delivery_status(self):
+        """ Save the last_notify, last_error and disabled fields set by deliver(). """
+
         Channel.objects.filter(id=self.id).update(
-            last_notify=now(), last_error=error, disabled=disabled
+            last_notify=self.last_notify,
+            last_error=self.last_error,
+            disabled=self.disabled,
         )
 
-        return error
-
     def icon_path(self):
         return "img/integrations/%s.png" % self.kind
 
     @property
     def json(self):
-        return json.loads(self.value)
+        """ Return self.value parsed as JSON.
+
+        The parsed document is memoized on the instance, and parsed again
+        only if self.value gets reassigned. This way transports can read
+        several fields from the same channel and only parse it once.
+
+        """
+
+        cached = getattr(self, "_json", None)
+        if cached is None or cached[0] is not self.value:
+            self._json = (self.value, json.loads(self.value))
+
+        return self._json[1]
 
     @property
     def po_priority(self):
@@ -610,7 +772,7 @@ class Channel(models.Model):
     def webhook_spec(self, status):
         assert self.kind == "webhook"
 
-        doc = json.loads(self.value)
+        doc = self.json
         if status == "down" and "method_down" in doc:
             return {
                 "method": doc["method_down"],
@@ -658,7 +820,7 @@ class Channel(models.Model):
         if not self.value.startswith("{"):
             return None
 
-        doc = json.loads(self.value)
+        doc = self.json
         if "team_name" in doc:
             return doc["team_name"]
 
@@ -671,7 +833,7 @@ class Channel(models.Model):
         if not self.value.startswith("{"):
             return None
 
-        doc = json.loads(self.value)
+        doc = self.json
         return doc["incoming_webhook"]["channel"]
 
     @property
@@ -680,7 +842,7 @@ class Channel(models.Model):
         if not self.value.startswith("{"):
             return self.value
 
-        doc = json.loads(self.value)
+        doc = self.json
         return doc["incoming_webhook"]["url"]
 
     @property
@@ -746,7 +908,7 @@ class Channel(models.Model):
     @property
     def trello_board_list(self):
         assert self.kind == "trello"
-        doc = json.loads(self.value)
+        doc = self.json
         return doc["board_name"], doc["list_name"]
 
     @property
@@ -801,11 +963,17 @@ class Channel(models.Model):
     @property
     def sms_notify_up(self):
         assert self.kind == "sms"
+        if not self.value.startswith("{"):
+            return False
+
         return self.json.get("up", False)
 
     @property
     def sms_notify_down(self):
         assert self.kind == "sms"
+        if not self.value.startswith("{"):
+            return True
+
         return self.json.get("down", True)
 
     @property
@@ -832,7 +1000,7 @@ class Channel(models.Model):
     @property
     def zulip_site(self):
         assert self.kind == "zulip"
-        doc = json.loads(self.value)
+        doc = self.json
         if "site" in doc:
             return doc["site"]
 
@@ -893,7 +1061,10 @@ class Flip(models.Model):
                 fields=["processed"],
                 name="api_flip_not_processed",
                 condition=models.Q(processed=None),
-            )
+            ),
+            # For looking up check's flips in a time window, newest first.
+            # Used in Check.downtimes() and in the flips API endpoint.
+            models.Index(fields=["owner", "-created"], name="api_flip_owner_created"),
         ]
 
     def to_dict(self):
@@ -903,7 +1074,7 @@ class Flip(models.Model):
         }
 
     def send_alerts(self):
-        """Loop over the enabled channels, call notify() on each.
+        """Loop over the enabled channels, deliver a notification to each.
 
         For each channel, yield a (channel, error, send_time) triple:
          * channel is a Channel instance
@@ -918,13 +1089,81 @@ class Flip(models.Model):
         if self.new_status not in ("up", "down"):
             raise NotImplementedError("Unexpected status: %s" % self.status)
 
-        for channel in self.owner.channel_set.exclude(disabled=True):
-            start = time.time()
-            error = channel.notify(self.owner)
-            if error == "no-op":
+        # Transports read channel.project, so fetch it in the same query:
+        q = self.owner.channel_set.exclude(disabled=True).select_related("project")
+        for channel in q:
+            if channel.transport.is_noop(self.owner):
                 continue
 
-            yield (channel, error, time.time() - start)
+            start = time.time()
+            n = channel.deliver(self.owner)
+            # Save the results right away, so the event log is up to date
+            # and a delivery status callback arriving later is not overwritten
+            channel.save_delivery_status()
+            if n.error:
+                Notification.objects.filter(id=n.id).update(error=n.error)
+            else:
+                # Leave the notification alone if it is not in the "Sending"
+                # state anymore: a delivery status callback has updated it.
+                q = Notification.objects.filter(id=n.id, error="Sending")
+                q.update(error="")
+
+            yield (channel, n.error, time.time() - start)
+
+
+# The current time, evaluated by the database
+NOW_SQL = {
+    "postgresql": "NOW()",
+    # Django stores naive UTC datetimes in MySQL
+    "mysql": "UTC_TIMESTAMP(6)",
+    "sqlite": "STRFTIME('%%Y-%%m-%%d %%H:%%M:%%f', 'now')",
+}
+
+
+class DatabaseNow(models.Func):
+    """ The current time, as NOW_SQL evaluates it. """
+
+    output_field = models.DateTimeField()
+
+    def as_sql(self, compiler, connection, **extra_context):
+        return NOW_SQL[connection.vendor], []
+
+
+# The token balance after topping up the bucket for the time elapsed since
+# the last update, as an SQL expression. Parameter: refill_time_secs.
+TOPPED_UP_SQL = {
+    "postgresql": "LEAST(1.0, tokens + EXTRACT(EPOCH FROM (NOW() - updated)) / %s)",
+    "mysql": (
+        "LEAST(1.0, tokens"
+        " + TIMESTAMPDIFF(MICROSECOND, updated, UTC_TIMESTAMP(6)) / 1000000.0 / %s)"
+    ),
+    "sqlite": (
+        "MIN(1.0, tokens"
+        " + (JULIANDAY('now') - JULIANDAY(updated)) * 86400.0 / %s)"
+    ),
+}
+
+# Tops up the bucket and takes a token, if there is a token to take.
+AUTHORIZE_TMPL = """
+UPDATE api_tokenbucket
+SET tokens = {topped_up} - %s, updated = {now}
+WHERE value = %s AND {topped_up} - %s >= 0
+"""
+AUTHORIZE_SQL = {
+    vendor: AUTHORIZE_TMPL.format(topped_up=topped_up, now=NOW_SQL[vendor])
+    for vendor, topped_up in TOPPED_UP_SQL.items()
+}
+
+
+@lru_cache(maxsize=4096)
+def _salted_hash(prefix, value, secret):
+    key = secret.encode()
+    if len(key) > 64:
+        # BLAKE2b keys can be at most 64 bytes long
+        key = hashlib.blake2b(key).digest()
+
+    digest = hashlib.blake2b(value.encode(), digest_size=20, key=key).hexdigest()
+    return "%s-%s" % (prefix, digest)
 
 
 class TokenBucket(models.Model):
@@ -934,26 +1173,42 @@ class TokenBucket(models.Model):
 
     @staticmethod
     def authorize(value, capacity, refill_time_secs):
-        frozen_now = now()
-        obj, created = TokenBucket.objects.get_or_create(value=value)
-
-        if not created:
-            # Top up the bucket:
-            delta_secs = (frozen_now - obj.updated).total_seconds()
-            obj.tokens = min(1.0, obj.tokens + delta_secs / refill_time_secs)
+        if settings.REDIS_URL:
+            # Keep the buckets in Redis, and stay off the database.
+            # If Redis is unavailable, use the database bucket instead.
+            try:
+                return take_token("tb:" + value, capacity, refill_time_secs)
+            except RedisError as e:
+                print("Redis error: ", e)
 
-        obj.tokens -= 1.0 / capacity
-        if obj.tokens < 0:
-            # Not enough tokens
-            return False
-
-        # Race condition: two concurrent authorize calls can overwrite each
-        # other's changes. It's OK to be a little inexact here for the sake
-        # of simplicity.
-        obj.updated = frozen_now
-        obj.save()
+        return TokenBucket._authorize_db(value, capacity, refill_time_secs)
 
-        return True
+    @staticmethod
+    def _authorize_db(value, capacity, refill_time_secs):
+        # Top up the bucket, and take a token, in a single UPDATE statement.
+        # The database evaluates the new balance against the current row,
+        # so concurrent authorize calls cannot overwrite each other's changes.
+        # The elapsed time is measured with the database's clock, the same
+        # clock that stamps new and updated rows.
+        # This runs for every rate-limited request, so skip the ORM and
+        # execute the SQL directly.
+        cost = 1.0 / capacity
+        params = [refill_time_secs, cost, value, refill_time_secs, cost]
+        with connection.cursor() as cursor:
+            cursor.execute(AUTHORIZE_SQL[connection.vendor], params)
+            if cursor.rowcount:
+                return True
+
+        # Nothing got updated: either the bucket does not exist yet or
+        # it does not have enough tokens. Look it up and create it in a
+        # single transaction.
+        # Stamp new buckets with the database's clock too.
+        defaults = {"tokens": 1.0 - 1.0 / capacity, "updated": DatabaseNow()}
+        with transaction.atomic():
+            q = TokenBucket.objects
+            obj, created = q.get_or_create(value=value, defaults=defaults)
+
+        return created
 
     @staticmethod
     def authorize_login_email(email):
@@ -963,8 +1218,7 @@ class TokenBucket(models.Model):
         mailbox = mailbox.split("+")[0]
         email = mailbox + "@" + domain
 
-        salted_encoded = (email + settings.SECRET_KEY).encode()
-        value = "em-%s" % hashlib.sha1(salted_encoded).hexdigest()
+        value = _salted_hash("em", email, settings.SECRET_KEY)
 
         # 20 login attempts for a single email per hour:
         return TokenBucket.authorize(value, 20, 3600)
@@ -978,8 +1232,7 @@ class TokenBucket(models.Model):
 
     @staticmethod
     def authorize_login_password(email):
-        salted_encoded = (email + settings.SECRET_KEY).encode()
-        value = "pw-%s" % hashlib.sha1(salted_encoded).hexdigest()
+        value = _salted_hash("pw", email, settings.SECRET_KEY)
 
         # 20 password attempts per day
         return TokenBucket.authorize(value, 20, 3600 * 24)
@@ -993,16 +1246,14 @@ class TokenBucket(models.Model):
 
     @staticmethod
     def authorize_signal(phone):
-        salted_encoded = (phone + settings.SECRET_KEY).encode()
-        value = "signal-%s" % hashlib.sha1(salted_encoded).hexdigest()
+        value = _salted_hash("signal", phone, settings.SECRET_KEY)
 
         # 6 messages for a single recipient per minute:
         return TokenBucket.authorize(value, 6, 60)
 
     @staticmethod
     def authorize_pushover(user_key):
-        salted_encoded = (user_key + settings.SECRET_KEY).encode()
-        value = "po-%s" % hashlib.sha1(salted_encoded).hexdigest()
+        value = _salted_hash("po", user_key, settings.SECRET_KEY)
         # 6 messages for a single user key per minute:
         return TokenBucket.authorize(value, 6, 60)
 
@@ -1028,4 +1279,11 @@ class TokenBucket(models.Model):
         # A code has a validity period of 3 * 30 = 90 seconds.
         # During that period, allow the code to only be used once,
         # so an eavesdropping attacker cannot reuse a code.
-        return TokenBucket.authorize(value, 1, 90)
+        if settings.REDIS_URL:
+            # A bucket with capacity 1 is a key that exists or does not
+            try:
+                return add_key("tb:" + value, 90)
+            except RedisError as e:
+                print("Redis error: ", e)
+
+        return TokenBucket._authorize_db(value, 1, 90)
@@ -1,6 +1,8 @@
 import json
+from unittest.mock import patch
 
-from hc.api.models import Channel
+from hc.api import transports
+from hc.api.models import Channel, Check
 from hc.test import BaseTestCase
 
 
@@ -55,3 +57,58 @@ class ChannelModelTestCase(BaseTestCase):
         c = Channel(kind="sms", value=json.dumps({"value": "+123123123"}))
         self.assertTrue(c.sms_notify_down)
         self.assertFalse(c.sms_notify_up)
+
+    def test_it_handles_legacy_sms_plain_value(self):
+        c = Channel(kind="sms", value="+123123123")
+        self.assertEqual(c.phone_number, "+123123123")
+        self.assertTrue(c.sms_notify_down)
+        self.assertFalse(c.sms_notify_up)
+
+    def test_notify_flags_skip_json_parsing_for_plain_values(self):
+        c = Channel(kind="email", value="alice@example.org")
+        with patch("hc.api.models.json.loads") as mock_loads:
+            self.assertTrue(c.email_notify_up)
+            self.assertTrue(c.email_notify_down)
+
+        self.assertFalse(mock_loads.called)
+
+    def test_transport_works(self):
+        c = Channel(kind="mattermost")
+        self.assertIsInstance(c.transport, transports.Slack)
+        self.assertEqual(c.transport.channel, c)
+
+    def test_transport_rejects_unknown_kind(self):
+        c = Channel(kind="zendesk")
+        with self.assertRaises(NotImplementedError):
+            c.transport
+
+    def test_json_reparses_changed_value(self):
+        c = Channel(kind="telegram", value=json.dumps({"id": 123}))
+        self.assertEqual(c.telegram_id, 123)
+
+        c.value = json.dumps({"id": 456})
+        self.assertEqual(c.telegram_id, 456)
+
+    def test_json_parses_value_once(self):
+        c = Channel(kind="slack")
+        c.value = json.dumps(
+            {"team_name": "foo", "incoming_webhook": {"channel": "#bar", "url": "x"}}
+        )
+
+        with patch("hc.api.models.json.loads", wraps=json.loads) as mock_loads:
+            self.assertEqual(c.slack_team, "foo")
+            self.assertEqual(c.slack_channel, "#bar")
+            self.assertEqual(c.slack_webhook_url, "x")
+
+        self.assertEqual(mock_loads.call_count, 1)
+
+    def test_assign_all_checks_works(self):
+        c1 = Check.objects.create(project=self.project)
+        c2 = Check.objects.create(project=self.project)
+        Check.objects.create(project=self.bobs_project)
+
+        channel = Channel.objects.create(project=self.project, kind="email")
+        channel.checks.add(c1)
+
+        channel.assign_all_checks()
+        self.assertEqual(set(channel.checks.all()), {c1, c2})
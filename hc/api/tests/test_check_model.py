@@ -1,9 +1,21 @@
+import uuid
 from datetime import datetime, timedelta as td
 from unittest.mock import Mock, patch
 
+from cronsim import CronSim
+from django.conf import settings
 from django.test.utils import override_settings
+from django.urls import reverse, set_script_prefix
 from django.utils import timezone
-from hc.api.models import Channel, Check, Flip, Notification, Ping
+from hc.api.models import (
+    Channel,
+    Check,
+    Flip,
+    Notification,
+    Ping,
+    isostring,
+    reverse_code,
+)
 from hc.test import BaseTestCase
 
 CURRENT_TIME = datetime(2020, 1, 15, tzinfo=timezone.utc)
@@ -20,6 +32,42 @@ class CheckModelTestCase(BaseTestCase):
         check.tags = " "
         self.assertEqual(check.tags_list(), [])
 
+    def test_tags_list_handles_reassigned_tags(self):
+        check = Check(tags="foo bar")
+        self.assertEqual(check.tags_list(), ["foo", "bar"])
+
+        check.tags = "baz"
+        self.assertEqual(check.tags_list(), ["baz"])
+
+    def test_tags_list_returns_a_copy(self):
+        check = Check(tags="foo bar")
+        check.tags_list().append("baz")
+
+        self.assertEqual(check.tags_list(), ["foo", "bar"])
+
+    def test_isostring_drops_microseconds(self):
+        dt = datetime(2020, 1, 15, 1, 2, 3, 456789, tzinfo=timezone.utc)
+        self.assertEqual(isostring(dt), "2020-01-15T01:02:03+00:00")
+        self.assertIsNone(isostring(None))
+
+    def test_set_name_slug_works(self):
+        check = Check()
+
+        check.set_name_slug("Foo Bar")
+        self.assertEqual(check.name, "Foo Bar")
+        self.assertEqual(check.slug, "foo-bar")
+
+        with patch("hc.api.models.slugify") as mock_slugify:
+            check.set_name_slug("Foo Bar")
+
+        self.assertFalse(mock_slugify.called)
+        self.assertEqual(check.slug, "foo-bar")
+
+    def test_set_name_slug_fills_missing_slug(self):
+        check = Check(name="Foo Bar")
+        check.set_name_slug("Foo Bar")
+        self.assertEqual(check.slug, "foo-bar")
+
     def test_get_status_handles_new_check(self):
         check = Check()
         self.assertEqual(check.get_status(), "new")
@@ -172,6 +220,86 @@ class CheckModelTestCase(BaseTestCase):
         d = check.to_dict()
         self.assertEqual(d["next_ping"], "2000-01-01T01:00:00+00:00")
 
+    def test_to_dict_runs_cronsim_once(self):
+        dt = timezone.make_aware(datetime(2000, 1, 1), timezone=timezone.utc)
+
+        check = Check(kind="cron", schedule="0 * * * *", status="up")
+        check.last_ping = dt
+
+        with patch("hc.api.models.CronSim", wraps=CronSim) as mock_cronsim:
+            check.to_dict(readonly=True)
+            check.going_down_after()
+
+        self.assertEqual(mock_cronsim.call_count, 1)
+
+    def test_it_stores_next_ping_on_save(self):
+        dt = timezone.make_aware(datetime(2000, 1, 1), timezone=timezone.utc)
+
+        check = Check(project=self.project, kind="cron", schedule="0 * * * *")
+        check.status = "up"
+        check.last_ping = dt
+        check.save()
+        self.assertEqual(check.next_ping, dt + td(hours=1))
+
+        # A check loaded from the database should use the stored value
+        with patch("hc.api.models.CronSim") as mock_cronsim:
+            check = Check.objects.get(id=check.id)
+            self.assertEqual(check.get_grace_start(), dt + td(hours=1))
+
+        self.assertFalse(mock_cronsim.called)
+
+        # Changing the schedule should invalidate the stored value
+        check.schedule = "*/5 * * * *"
+        self.assertEqual(check.get_grace_start(), dt + td(minutes=5))
+
+    def test_it_clears_next_ping_for_simple_checks(self):
+        check = Check(project=self.project, kind="cron", status="up")
+        check.last_ping = timezone.now()
+        check.save()
+        self.assertIsNotNone(check.next_ping)
+
+        check.kind = "simple"
+        check.save()
+        self.assertIsNone(check.next_ping)
+
+    def test_cron_next_ping_recalculates_after_changes(self):
+        dt = timezone.make_aware(datetime(2000, 1, 1), timezone=timezone.utc)
+
+        check = Check(kind="cron", schedule="0 * * * *", status="up")
+        check.last_ping = dt
+        self.assertEqual(check.cron_next_ping(), dt + td(hours=1))
+
+        check.schedule = "*/5 * * * *"
+        self.assertEqual(check.cron_next_ping(), dt + td(minutes=5))
+
+        check.last_ping = dt + td(minutes=7)
+        self.assertEqual(check.cron_next_ping(), dt + td(minutes=10))
+
+    def test_url_helpers_match_reverse(self):
+        check = Check.objects.create(project=self.project)
+
+        path = reverse("hc-details", args=[check.code])
+        self.assertEqual(check.details_url(), settings.SITE_ROOT + path)
+
+        path = reverse("hc-uncloak", args=[check.unique_key])
+        self.assertEqual(check.cloaked_url(), settings.SITE_ROOT + path)
+
+        d = check.to_dict()
+        path = reverse("hc-api-pause", args=[check.code])
+        self.assertEqual(d["pause_url"], settings.SITE_ROOT + path)
+
+    def test_reverse_code_uses_current_script_prefix(self):
+        code = uuid.uuid4()
+        self.assertEqual(reverse_code("hc-details", code), "/checks/%s/details/" % code)
+
+        set_script_prefix("/hc/")
+        try:
+            path = reverse_code("hc-details", code)
+        finally:
+            set_script_prefix("/")
+
+        self.assertEqual(path, "/hc/checks/%s/details/" % code)
+
     @patch("hc.api.models.now", MOCK_NOW)
     @patch("hc.lib.date.timezone.now", MOCK_NOW)
     def test_downtimes_handles_no_flips(self):
@@ -254,6 +382,35 @@ class CheckModelTestCase(BaseTestCase):
                 self.assertEqual(downtime.total_seconds(), 0)
                 self.assertEqual(outages, 0)
 
+    @patch("hc.api.models.now", MOCK_NOW)
+    @patch("hc.lib.date.timezone.now", MOCK_NOW)
+    def test_downtimes_handles_multiple_outages_in_a_month(self):
+        check = Check.objects.create(project=self.project, status="up")
+        check.created = datetime(2019, 1, 1, tzinfo=timezone.utc)
+
+        # Two one-hour outages in December, created out of order
+        for day in (20, 10):
+            down = datetime(2019, 12, day, tzinfo=timezone.utc)
+            Flip.objects.create(
+                owner=check, created=down, old_status="up", new_status="down"
+            )
+            Flip.objects.create(
+                owner=check,
+                created=down + td(hours=1),
+                old_status="down",
+                new_status="up",
+            )
+
+        r = check.downtimes(3)
+        self.assertEqual(len(r), 3)
+        for dt, downtime, outages in r:
+            if dt.month == 12:
+                self.assertEqual(downtime.total_seconds(), 2 * 3600)
+                self.assertEqual(outages, 2)
+            else:
+                self.assertEqual(downtime.total_seconds(), 0)
+                self.assertEqual(outages, 0)
+
     @patch("hc.api.models.now", MOCK_NOW)
     @patch("hc.lib.date.timezone.now", MOCK_NOW)
     def test_downtimes_handles_months_when_check_did_not_exist(self):
@@ -294,6 +451,25 @@ class CheckModelTestCase(BaseTestCase):
 
         self.assertEqual(Notification.objects.count(), 0)
 
+    def test_prune_uses_few_queries(self):
+        check = Check.objects.create(project=self.project, n_pings=101)
+        Ping.objects.create(owner=check, n=101)
+        Ping.objects.create(owner=check, n=1)
+
+        # DELETE pings, DELETE notifications
+        with self.assertNumQueries(2):
+            check.prune()
+
+    @override_settings(S3_BUCKET="test-bucket")
+    @patch("hc.api.models.remove_objects")
+    def test_prune_skips_checks_with_few_pings(self, remove_objects):
+        check = Check.objects.create(project=self.project, n_pings=100)
+        Ping.objects.create(owner=check, n=1)
+
+        check.prune()
+        self.assertTrue(Ping.objects.exists())
+        self.assertFalse(remove_objects.called)
+
     @override_settings(S3_BUCKET="test-bucket")
     @patch("hc.api.models.remove_objects")
     def test_it_prunes_object_storage(self, remove_objects):
@@ -306,3 +482,15 @@ class CheckModelTestCase(BaseTestCase):
         code, upto_n = args
         self.assertEqual(code, check.code)
         self.assertEqual(upto_n, 1)
+
+    def test_assign_all_channels_handles_moved_check(self):
+        check = Check.objects.create(project=self.project)
+        old = Channel.objects.create(project=self.project, kind="email")
+        old.checks.add(check)
+
+        new = Channel.objects.create(project=self.bobs_project, kind="email")
+        check.project = self.bobs_project
+        check.save()
+        check.assign_all_channels()
+
+        self.assertEqual(list(check.channel_set.all()), [new])
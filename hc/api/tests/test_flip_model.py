@@ -1,7 +1,8 @@
 from unittest.mock import patch
 
 from django.utils.timezone import now
-from hc.api.models import Channel, Check, Flip
+from hc.api.models import Channel, Check, Flip, Notification
+from hc.api.transports import TransportError
 from hc.test import BaseTestCase
 
 
@@ -17,10 +18,8 @@ class FlipModelTestCase(BaseTestCase):
         self.flip.old_status = "up"
         self.flip.new_status = "down"
 
-    @patch("hc.api.models.Channel.notify")
+    @patch("hc.api.transports.Email.notify")
     def test_send_alerts_works(self, mock_notify):
-        mock_notify.return_value = ""
-
         results = list(self.flip.send_alerts())
         self.assertEqual(len(results), 1)
 
@@ -28,9 +27,71 @@ class FlipModelTestCase(BaseTestCase):
         self.assertEqual(ch, self.channel)
         self.assertEqual(error, "")
 
-    @patch("hc.api.models.Channel.notify")
+        n = Notification.objects.get()
+        self.assertEqual(n.owner, self.check)
+        self.assertEqual(n.error, "")
+
+        self.channel.refresh_from_db()
+        self.assertTrue(self.channel.last_notify)
+        self.assertEqual(self.channel.last_error, "")
+
+    @patch("hc.api.transports.Email.notify")
+    def test_send_alerts_fetches_projects_with_channels(self, mock_notify):
+        channel2 = Channel.objects.create(project=self.project, kind="email")
+        channel2.checks.add(self.check)
+
+        # 1 query to fetch channels and projects, 2 notification INSERTs,
+        # 2 channel UPDATEs, 2 notification UPDATEs
+        with self.assertNumQueries(7):
+            for ch, error, send_time in self.flip.send_alerts():
+                self.assertEqual(ch.project.name, self.project.name)
+
+    @patch("hc.api.transports.Email.notify")
+    def test_send_alerts_saves_results_right_away(self, mock_notify):
+        channel2 = Channel.objects.create(project=self.project, kind="email")
+        channel2.checks.add(self.check)
+
+        alerts = self.flip.send_alerts()
+        next(alerts)
+        # The first notification is saved before the second channel is notified
+        n = Notification.objects.get()
+        self.assertEqual(n.error, "")
+
+    @patch("hc.api.transports.Email.notify")
+    def test_send_alerts_keeps_notification_updates_from_callbacks(self, mock_notify):
+        def notify(check, notification):
+            # A delivery status callback arrives before notify() returns
+            q = Notification.objects.filter(id=notification.id)
+            q.update(error="Delivery failed")
+
+        mock_notify.side_effect = notify
+        list(self.flip.send_alerts())
+
+        n = Notification.objects.get()
+        self.assertEqual(n.error, "Delivery failed")
+
+    @patch("hc.api.transports.Email.notify")
+    def test_send_alerts_keeps_channel_updates_from_callbacks(self, mock_notify):
+        channel2 = Channel.objects.create(project=self.project, kind="email")
+        channel2.checks.add(self.check)
+
+        def notify(check, notification):
+            if notification.channel_id == channel2.id:
+                # A delivery status callback for the first channel arrives
+                # while the second channel is being notified
+                q = Channel.objects.filter(id=self.channel.id)
+                q.update(last_error="Delivery failed", disabled=True)
+
+        mock_notify.side_effect = notify
+        list(self.flip.send_alerts())
+
+        self.channel.refresh_from_db()
+        self.assertEqual(self.channel.last_error, "Delivery failed")
+        self.assertTrue(self.channel.disabled)
+
+    @patch("hc.api.transports.Email.notify")
     def test_send_alerts_handles_error(self, mock_notify):
-        mock_notify.return_value = "something went wrong"
+        mock_notify.side_effect = TransportError("something went wrong")
 
         results = list(self.flip.send_alerts())
         self.assertEqual(len(results), 1)
@@ -38,21 +99,52 @@ class FlipModelTestCase(BaseTestCase):
         ch, error, send_time = results[0]
         self.assertEqual(error, "something went wrong")
 
-    @patch("hc.api.models.Channel.notify")
-    def test_send_alerts_handles_noop(self, mock_notify):
+        n = Notification.objects.get()
+        self.assertEqual(n.error, "something went wrong")
+
+        self.channel.refresh_from_db()
+        self.assertEqual(self.channel.last_error, "something went wrong")
+        self.assertFalse(self.channel.disabled)
+
+    @patch("hc.api.transports.Email.notify")
+    def test_send_alerts_disables_channel_on_permanent_error(self, mock_notify):
+        mock_notify.side_effect = TransportError("gone", permanent=True)
+
+        list(self.flip.send_alerts())
+
+        self.channel.refresh_from_db()
+        self.assertTrue(self.channel.disabled)
+
+    @patch("hc.api.transports.Email.notify")
+    def test_send_alerts_keeps_status_callback_error(self, mock_notify):
+        def notify(check, notification=None):
+            # Simulate a delivery status callback arriving during sending
+            notification.error = "Delivery failed"
+            notification.save()
+
+        mock_notify.side_effect = notify
+
+        list(self.flip.send_alerts())
+
+        n = Notification.objects.get()
+        self.assertEqual(n.error, "Delivery failed")
 
-        mock_notify.return_value = "no-op"
+    @patch("hc.api.transports.Email.is_noop")
+    def test_send_alerts_handles_noop(self, mock_is_noop):
+        mock_is_noop.return_value = True
 
         results = list(self.flip.send_alerts())
         self.assertEqual(results, [])
+        self.assertFalse(Notification.objects.exists())
 
-    @patch("hc.api.models.Channel.notify")
+    @patch("hc.api.transports.Email.notify")
     def test_send_alerts_handles_new_up_transition(self, mock_notify):
         self.flip.old_status = "new"
         self.flip.new_status = "up"
 
         results = list(self.flip.send_alerts())
         self.assertEqual(results, [])
+        self.assertFalse(mock_notify.called)
 
     def test_it_skips_disabled_channels(self):
         self.channel.disabled = True
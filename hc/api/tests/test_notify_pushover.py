@@ -65,8 +65,8 @@ class NotifyPushoverTestCase(BaseTestCase):
     def test_it_obeys_rate_limit(self, mock_post):
         self._setup_data("123|0")
 
-        # "c0ca..." is sha1("123test-secret")
-        obj = TokenBucket(value="po-c0ca2a9774952af32cabf86453f69e442c4ed0eb")
+        # "6bd7..." is blake2b("123", key="test-secret")
+        obj = TokenBucket(value="po-6bd75bd06a488e3fa95efed0f3c406ac06bcdbef")
         obj.tokens = 0
         obj.save()
 
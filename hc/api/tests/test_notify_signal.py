@@ -125,8 +125,8 @@ class NotifySignalTestCase(BaseTestCase):
     @override_settings(SECRET_KEY="test-secret")
     @patch("hc.api.transports.socket.socket")
     def test_it_obeys_rate_limit(self, socket):
-        # "2862..." is sha1("+123456789test-secret")
-        obj = TokenBucket(value="signal-2862991ccaa15c8856e7ee0abaf3448fb3c292e0")
+        # "6d57..." is blake2b("+123456789", key="test-secret")
+        obj = TokenBucket(value="signal-6d5756d89a1881e03de62f69ce3c1f7ccdee3f16")
         obj.tokens = 0
         obj.save()
 
@@ -135,6 +135,24 @@ class PingTestCase(BaseTestCase):
         self.check.refresh_from_db()
         self.assertTrue(self.check.has_confirmation_link)
 
+    def test_it_finds_confirmation_link_in_non_utf8_body(self):
+        payload = b"\xe9\xe9 CONFIRM \xff"
+        r = self.client.post(self.url, data=payload, content_type="text/plain")
+        self.assertEqual(r.status_code, 200)
+
+        self.check.refresh_from_db()
+        self.assertTrue(self.check.has_confirmation_link)
+
+    def test_it_clears_confirmation_flag(self):
+        self.check.has_confirmation_link = True
+        self.check.save()
+
+        r = self.client.post(self.url, data="Hello", content_type="text/plain")
+        self.assertEqual(r.status_code, 200)
+
+        self.check.refresh_from_db()
+        self.assertFalse(self.check.has_confirmation_link)
+
     def test_fail_endpoint_works(self):
         r = self.client.get(self.url + "/fail")
         self.assertEqual(r.status_code, 200)
@@ -267,17 +285,52 @@ class PingTestCase(BaseTestCase):
         self.assertEqual(bytes(ping.body_raw), b"Hello \xe9 World")
 
     @override_settings(S3_BUCKET="test-bucket")
-    @patch("hc.api.models.put_object")
-    def test_it_uploads_body_to_s3(self, put_object):
-        r = self.client.post(self.url, b"a" * 101, content_type="text/plain")
-        self.assertEqual(r.status_code, 200)
+    @patch("hc.api.models.put_object_async")
+    def test_it_uploads_body_to_s3(self, put_object_async):
+        # The upload should start only after the transaction commits
+        with self.captureOnCommitCallbacks(execute=True):
+            r = self.client.post(self.url, b"a" * 101, content_type="text/plain")
+            self.assertEqual(r.status_code, 200)
+            self.assertFalse(put_object_async.called)
 
         ping = Ping.objects.get()
         self.assertEqual(ping.method, "POST")
         self.assertEqual(ping.object_size, 101)
 
-        args, kwargs = put_object.call_args
-        code, n, data = args
+        args, kwargs = put_object_async.call_args
+        code, n, data, fallback = args
         self.assertEqual(code, self.check.code)
         self.assertEqual(n, 1)
         self.assertEqual(data, b"a" * 101)
+
+        # If the upload fails, the body should get stored in the database
+        fallback()
+        ping.refresh_from_db()
+        self.assertIsNone(ping.object_size)
+        self.assertEqual(bytes(ping.body_raw), b"a" * 101)
+
+    def test_it_does_not_overwrite_unrelated_fields(self):
+        # Simulate a concurrent edit to the check in another request
+        Check.objects.filter(id=self.check.id).update(name="Renamed")
+
+        self.check.ping("1.2.3.4", "http", "get", "", b"", "success")
+        self.assertEqual(self.check.n_pings, 1)
+
+        self.check.refresh_from_db()
+        self.assertEqual(self.check.name, "Renamed")
+        self.assertEqual(self.check.n_pings, 1)
+        self.assertEqual(self.check.status, "up")
+
+    def test_it_picks_up_concurrent_changes(self):
+        # Simulate another ping being processed after self.check was loaded
+        Check.objects.filter(id=self.check.id).update(n_pings=5, status="up")
+
+        self.check.ping("1.2.3.4", "http", "get", "", b"", "fail")
+        self.assertEqual(self.check.n_pings, 6)
+
+        ping = Ping.objects.get()
+        self.assertEqual(ping.n, 6)
+
+        flip = Flip.objects.get()
+        self.assertEqual(flip.old_status, "up")
+        self.assertEqual(flip.new_status, "down")
@@ -1,12 +1,14 @@
 from datetime import timedelta as td
+from unittest.mock import patch
 
 from django.test.utils import override_settings
 from django.utils.timezone import now
 from hc.api.models import TokenBucket
+from hc.lib.redis import RedisError
 from hc.test import BaseTestCase
 
-# This is sha1("alice@example.org" + "test-secred")
-ALICE_HASH = "d60db3b2343e713a4de3e92d4eb417e4f05f06ab"
+# This is blake2b("alice@example.org", digest_size=20, key="test-secret")
+ALICE_HASH = "a7b43dd0c9e33647cf366b88800c6060c8050e76"
 
 
 @override_settings(SECRET_KEY="test-secret")
@@ -18,6 +20,7 @@ class TokenBucketTestCase(BaseTestCase):
         obj = TokenBucket.objects.get()
         self.assertEqual(obj.tokens, 0.95)
         self.assertEqual(obj.value, "em-" + ALICE_HASH)
+        self.assertTrue(now() - td(minutes=1) < obj.updated <= now())
 
     def test_it_handles_insufficient_tokens(self):
         TokenBucket.objects.create(value="em-" + ALICE_HASH, tokens=0.04)
@@ -37,6 +40,16 @@ class TokenBucketTestCase(BaseTestCase):
         obj.refresh_from_db()
         self.assertAlmostEqual(obj.tokens, 0.45, places=5)
 
+    def test_it_updates_timestamp(self):
+        obj = TokenBucket(value="em-" + ALICE_HASH)
+        obj.updated = now() - td(minutes=30)
+        obj.save()
+
+        TokenBucket.authorize_login_email("alice@example.org")
+
+        obj.refresh_from_db()
+        self.assertTrue(now() - td(minutes=1) < obj.updated <= now())
+
     def test_it_normalizes_email(self):
         emails = ("alice+alias@example.org", "a.li.ce@example.org")
 
@@ -44,3 +57,79 @@ class TokenBucketTestCase(BaseTestCase):
             TokenBucket.authorize_login_email(email)
 
         self.assertEqual(TokenBucket.objects.count(), 1)
+
+    def test_it_runs_out_of_tokens(self):
+        for i in range(20):
+            self.assertTrue(TokenBucket.authorize_login_email("alice@example.org"))
+
+        self.assertFalse(TokenBucket.authorize_login_email("alice@example.org"))
+
+        obj = TokenBucket.objects.get()
+        self.assertAlmostEqual(obj.tokens, 0.0, places=3)
+
+    def test_it_uses_single_query_for_existing_bucket(self):
+        TokenBucket.objects.create(value="em-" + ALICE_HASH)
+
+        with self.assertNumQueries(1):
+            r = TokenBucket.authorize_login_email("alice@example.org")
+
+        self.assertTrue(r)
+
+    @override_settings(SECRET_KEY="x" * 100)
+    def test_it_handles_long_secret_key(self):
+        self.assertTrue(TokenBucket.authorize_login_email("alice@example.org"))
+
+        obj = TokenBucket.objects.get()
+        self.assertEqual(len(obj.value), len("em-" + ALICE_HASH))
+
+    def test_it_authorizes_sudo_code(self):
+        self.assertTrue(TokenBucket.authorize_sudo_code(self.alice))
+
+        obj = TokenBucket.objects.get()
+        self.assertEqual(obj.value, "sudo-%d" % self.alice.id)
+
+    @override_settings(REDIS_URL="redis://localhost:6379/0")
+    @patch("hc.api.models.take_token")
+    def test_it_uses_redis(self, take_token):
+        take_token.return_value = True
+
+        with self.assertNumQueries(0):
+            r = TokenBucket.authorize_login_email("alice@example.org")
+
+        self.assertTrue(r)
+        take_token.assert_called_once_with("tb:em-" + ALICE_HASH, 20, 3600)
+        self.assertFalse(TokenBucket.objects.exists())
+
+    @override_settings(REDIS_URL="redis://localhost:6379/0")
+    @patch("hc.api.models.add_key")
+    def test_it_uses_redis_for_totp_codes(self, add_key):
+        add_key.return_value = False
+
+        r = TokenBucket.authorize_totp_code(self.alice, "000000")
+
+        self.assertFalse(r)
+        add_key.assert_called_once_with("tb:totpc-%d-000000" % self.alice.id, 90)
+
+    @override_settings(REDIS_URL="redis://localhost:6379/0")
+    @patch("hc.api.models.print", create=True)
+    @patch("hc.api.models.take_token")
+    def test_it_falls_back_to_database(self, take_token, mock_print):
+        take_token.side_effect = RedisError("Timeout reading from socket")
+
+        r = TokenBucket.authorize_login_email("alice@example.org")
+
+        self.assertTrue(r)
+        obj = TokenBucket.objects.get()
+        self.assertEqual(obj.value, "em-" + ALICE_HASH)
+
+    @override_settings(REDIS_URL="redis://localhost:6379/0")
+    @patch("hc.api.models.print", create=True)
+    @patch("hc.api.models.take_token")
+    @patch("hc.api.models.add_key")
+    def test_totp_code_falls_back_to_database(self, add_key, take_token, mock_print):
+        add_key.side_effect = RedisError("Connection refused")
+
+        self.assertTrue(TokenBucket.authorize_totp_code(self.alice, "000000"))
+        self.assertFalse(TokenBucket.authorize_totp_code(self.alice, "000000"))
+        # Redis is not tried again for the database fallback
+        self.assertFalse(take_token.called)
@@ -132,7 +132,7 @@ class Shell(Transport):
         ctx = {
             "$CODE": str(check.code),
             "$STATUS": check.status,
-            "$NOW": timezone.now().replace(microsecond=0).isoformat(),
+            "$NOW": timezone.now().isoformat(timespec="seconds"),
             "$NAME": check.name,
             "$TAGS": check.tags,
         }
@@ -233,7 +233,7 @@ class Webhook(HttpTransport):
         ctx = {
             "$CODE": str(check.code),
             "$STATUS": check.status,
-            "$NOW": safe(timezone.now().replace(microsecond=0).isoformat()),
+            "$NOW": safe(timezone.now().isoformat(timespec="seconds")),
             "$NAME": safe(check.name),
             "$TAGS": safe(check.tags),
         }
@@ -175,7 +175,7 @@ def format_headers(headers):
 
 @register.simple_tag
 def now_isoformat():
-    return now().replace(microsecond=0).isoformat()
+    return now().isoformat(timespec="seconds")
 
 
 @register.filter
@@ -0,0 +1,93 @@
+from django.conf import settings
+
+try:
+    import redis
+    from redis import RedisError
+except ImportError:
+    # Enforce
+    settings.REDIS_URL = None
+
+    class RedisError(Exception):
+        pass
+
+
+_client = None
+_take_token_script = None
+# Socket timeout in seconds for Redis commands
+TIMEOUT = 0.5
+
+# Tops up the bucket and takes a token in one atomic step on the Redis
+# server. The bucket is stored in a hash with "tokens" and "updated" fields.
+# A full bucket is the same as a missing bucket, so the key is set to
+# expire once it would have refilled completely.
+# The script calls TIME before writing, which requires Redis 5.0 or later
+# (scripts are replicated by their effects, not by their source).
+#
+# KEYS[1]: bucket key
+# ARGV[1]: capacity
+# ARGV[2]: refill time in seconds
+TAKE_TOKEN_LUA = """
+local t = redis.call("TIME")
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local capacity = tonumber(ARGV[1])
+local refill_time_secs = tonumber(ARGV[2])
+
+local tokens = 1.0
+local state = redis.call("HMGET", KEYS[1], "tokens", "updated")
+if state[1] then
+    local elapsed_secs = now - tonumber(state[2])
+    tokens = math.min(1.0, tonumber(state[1]) + elapsed_secs / refill_time_secs)
+end
+
+tokens = tokens - 1.0 / capacity
+if tokens < 0 then
+    return 0
+end
+
+redis.call("HSET", KEYS[1], "tokens", tostring(tokens), "updated", tostring(now))
+redis.call("EXPIRE", KEYS[1], math.ceil(refill_time_secs))
+return 1
+"""
+
+
+def client():
+    if not settings.REDIS_URL:
+        raise Exception("Redis is not configured")
+
+    global _client
+    if _client is None:
+        # Rate limiting runs on every login attempt. Fail fast if Redis
+        # is unreachable, the caller then falls back to the database.
+        _client = redis.Redis.from_url(
+            settings.REDIS_URL,
+            socket_timeout=TIMEOUT,
+            socket_connect_timeout=TIMEOUT,
+        )
+
+    return _client
+
+
+def take_token(key, capacity, refill_time_secs):
+    """Takes a token from the bucket `key`, returns True on success.
+
+    Uses the same refill logic as `TokenBucket.authorize`, but keeps the
+    bucket in Redis instead of the database.
+
+    """
+
+    global _take_token_script
+    if _take_token_script is None:
+        _take_token_script = client().register_script(TAKE_TOKEN_LUA)
+
+    result = _take_token_script(keys=[key], args=[capacity, refill_time_secs])
+    return bool(result)
+
+
+def add_key(key, ttl):
+    """Creates `key` with expiry `ttl` seconds, if it does not exist yet.
+
+    Returns True if the key was created.
+
+    """
+
+    return bool(client().set(key, 1, nx=True, ex=ttl))
@@ -1,17 +1,63 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from io import BytesIO
-from threading import Thread
+from itertools import islice, takewhile
+from threading import Lock
 
+from django import db
 from django.conf import settings
+from django.core.cache import cache
 
 try:
     from minio import Minio, S3Error
     from minio.deleteobjects import DeleteObject
     from urllib3 import PoolManager
+    from urllib3.exceptions import HTTPError
+    from urllib3.util.retry import Retry
 except ImportError:
     # Enforce
     settings.S3_BUCKET = None
 
 _client = None
+_client_lock = Lock()
+# Background threads for uploading ping bodies
+_uploader = ThreadPoolExecutor(max_workers=4, thread_name_prefix="s3-upload")
+# Background threads for listing and removing old ping bodies
+_remover = ThreadPoolExecutor(max_workers=4, thread_name_prefix="s3-remove")
+# Queued removals, {check code: upto_n}
+_pending = {}
+_pending_lock = Lock()
+# Background threads for sending DeleteObjects requests
+_deleter = ThreadPoolExecutor(max_workers=8, thread_name_prefix="s3-delete")
+# DeleteObjects accepts up to 1000 keys per request
+DELETE_BATCH_SIZE = 1000
+# Keep enough idle connections around for all of the above threads,
+# so uploads and deletes reuse connections instead of reconnecting
+POOL_MAXSIZE = 16
+# Memory budget for caching recently read objects
+CACHE_MAX_BYTES = 16 * 1024 * 1024
+# How long to remember the highest n removed for each check
+REMOVED_UPTO_TTL = 24 * 3600
+
+
+def _http_client():
+    return PoolManager(
+        timeout=settings.S3_TIMEOUT,
+        maxsize=POOL_MAXSIZE,
+        # This is the only retry layer for S3 requests. Retry 5xx responses
+        # (including S3's "InternalError") with exponential backoff. Do not
+        # retry read timeouts: such a request has already waited S3_TIMEOUT
+        # seconds, and retrying would hold a worker thread for minutes.
+        retries=Retry(
+            total=3,
+            read=0,
+            backoff_factor=0.2,
+            status_forcelist=[500, 502, 503, 504],
+            # After the last retry, return the 5xx response instead of
+            # raising MaxRetryError, so that minio raises S3Error for it
+            raise_on_status=False,
+        ),
+    )
 
 
 def client():
@@ -20,19 +66,23 @@ def client():
 
     global _client
     if _client is None:
-        _client = Minio(
-            settings.S3_ENDPOINT,
-            settings.S3_ACCESS_KEY,
-            settings.S3_SECRET_KEY,
-            region=settings.S3_REGION,
-            http_client=PoolManager(timeout=settings.S3_TIMEOUT),
-        )
+        # Several background threads may ask for the client at the same time
+        with _client_lock:
+            if _client is None:
+                _client = Minio(
+                    settings.S3_ENDPOINT,
+                    settings.S3_ACCESS_KEY,
+                    settings.S3_SECRET_KEY,
+                    region=settings.S3_REGION,
+                    http_client=_http_client(),
+                )
 
     return _client
 
 
-ASCII_J = ord("j")
 ASCII_Z = ord("z")
+# Maps digits 0-9 to letters j-a
+DIGIT_FLIP = str.maketrans("0123456789", "jihgfedcba")
 
 
 def enc(n):
@@ -55,19 +105,84 @@ def enc(n):
 
     """
 
+    if 0 <= n < len(_SMALL_ENC):
+        return _SMALL_ENC[n]
+
+    return _enc(n)
+
+
+def _enc(n):
     s = str(n)
     len_inverted = chr(ASCII_Z - len(s) + 1)
-    inverted = "".join(chr(ASCII_J - int(c)) for c in s)
+    inverted = s.translate(DIGIT_FLIP)
     return len_inverted + inverted + "-" + s
 
 
+# Precomputed keys for small n values
+_SMALL_ENC = [_enc(i) for i in range(1024)]
+
+
+class BodyCache(object):
+    """A thread-safe LRU cache of object contents, bounded by total size.
+
+    Objects are never modified after upload, so repeat reads of the same
+    key can be served from memory without an S3 round trip.
+
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.items = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, key):
+        with self.lock:
+            data = self.items.get(key)
+            if data is not None:
+                self.items.move_to_end(key)
+            return data
+
+    def set(self, key, data):
+        if len(data) > self.max_bytes:
+            return
+
+        with self.lock:
+            self._discard(key)
+            self.items[key] = data
+            self.size += len(data)
+            while self.size > self.max_bytes:
+                _, evicted = self.items.popitem(last=False)
+                self.size -= len(evicted)
+
+    def discard(self, key):
+        with self.lock:
+            self._discard(key)
+
+    def _discard(self, key):
+        data = self.items.pop(key, None)
+        if data is not None:
+            self.size -= len(data)
+
+
+_cache = BodyCache(max_bytes=CACHE_MAX_BYTES)
+
+
 def get_object(code, n):
     key = "%s/%s" % (code, enc(n))
+    data = _cache.get(key)
+    if data is not None:
+        return data
+
     response = None
     try:
         response = client().get_object(settings.S3_BUCKET, key)
-        return response.read()
-    except S3Error:
+        data = response.read()
+        _cache.set(key, data)
+        return data
+    except (S3Error, HTTPError):
+        # Treat the object as missing if the S3 service is unavailable,
+        # or the request timed out
         return None
     finally:
         if response:
@@ -77,34 +192,110 @@ def get_object(code, n):
 
 def put_object(code, n, data):
     key = "%s/%s" % (code, enc(n))
-    while True:
-        try:
-            client().put_object(settings.S3_BUCKET, key, BytesIO(data), len(data))
-            break
-        except S3Error as e:
-            if e.code != "InternalError":
-                raise e
+    _cache.discard(key)
+    client().put_object(settings.S3_BUCKET, key, BytesIO(data), len(data))
+
+
+def _put_object(code, n, data, fallback):
+    try:
+        put_object(code, n, data)
+    except Exception as e:
+        print("put_object error: ", e)
+        if fallback:
+            fallback()
+    finally:
+        # The fallback may have used a database connection on this thread
+        db.connections.close_all()
+
+
+def put_object_async(code, n, data, fallback=None):
+    """Uploads the object on a background thread, and returns a Future.
+
+    The caller does not have to wait for the S3 API call to complete.
+    If the upload fails, calls `fallback` (also on the background thread).
+
+    """
 
-            print("InternalError, retrying...")
+    return _uploader.submit(_put_object, code, n, data, fallback)
 
 
 def _remove_objects(code, upto_n):
     prefix = "%s/" % code
     start_after = prefix + enc(upto_n + 1)
-    q = client().list_objects(settings.S3_BUCKET, prefix, start_after=start_after)
-    delete_objs = [DeleteObject(obj.object_name) for obj in q]
-    if delete_objs:
-        errors = client().remove_objects(settings.S3_BUCKET, delete_objs)
-        for e in errors:
+    q = client().list_objects(
+        settings.S3_BUCKET,
+        prefix,
+        start_after=start_after,
+        # Keys are flat under the prefix, no need for delimiter grouping
+        recursive=True,
+        # Object keys are plain ASCII, no need to URL-encode them
+        use_url_encoding_type=False,
+    )
+    # Keys are listed in sorted order, so stop at the first key
+    # outside this check's "directory"
+    q = takewhile(lambda obj: obj.object_name.startswith(prefix), q)
+    delete_objs = (DeleteObject(obj.object_name) for obj in q)
+
+    # Send the DeleteObjects requests concurrently, one per batch,
+    # while the listing is still in progress
+    futures = []
+    while batch := list(islice(delete_objs, DELETE_BATCH_SIZE)):
+        futures.append(_deleter.submit(_remove_batch, batch))
+
+    ok = True
+    for future in as_completed(futures):
+        for e in future.result():
             print("remove_objects error: ", e)
+            ok = False
+
+    if ok:
+        # Remember how far we got, so remove_objects can skip calls
+        # that would find nothing to remove
+        cache.set(_removed_upto_key(code), upto_n, REMOVED_UPTO_TTL)
+
+
+def _removed_upto_key(code):
+    return "s3:min_n:%s" % code
+
+
+def _remove_batch(delete_objs):
+    # remove_objects returns a lazy iterator, the request gets sent
+    # only when the iterator is consumed
+    return list(client().remove_objects(settings.S3_BUCKET, delete_objs))
+
+
+def _remove_pending(code):
+    with _pending_lock:
+        upto_n = _pending.pop(code)
+
+    try:
+        _remove_objects(code, upto_n)
+    except Exception as e:
+        # Nobody waits on the Future, so report the error here
+        print("remove_objects error: ", e)
 
 
 def remove_objects(check_code, upto_n):
     """Removes keys with n values below or equal to `upto_n`.
 
     The S3 API calls can take seconds to complete,
-    therefore run the removal code on thread.
+    therefore run the removal code on a background thread.
+    If a removal for the same check is already queued, it gets extended
+    to cover `upto_n` instead of queueing another one.
+
+    Returns a Future, or None if no new removal was queued.
 
     """
 
-    Thread(target=_remove_objects, args=(check_code, upto_n)).start()
+    if upto_n <= cache.get(_removed_upto_key(check_code), 0):
+        # Keys up to and including upto_n have already been removed
+        return None
+
+    with _pending_lock:
+        if check_code in _pending:
+            _pending[check_code] = max(_pending[check_code], upto_n)
+            return None
+
+        _pending[check_code] = upto_n
+
+    return _remover.submit(_remove_pending, check_code)
@@ -0,0 +1,60 @@
+from unittest.mock import patch
+
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from hc.lib.redis import TAKE_TOKEN_LUA, add_key, client, take_token
+
+
+@override_settings(REDIS_URL="redis://localhost:6379/0")
+@patch("hc.lib.redis._take_token_script", None)
+@patch("hc.lib.redis._client", None)
+@patch("hc.lib.redis.redis", create=True)
+class RedisTestCase(TestCase):
+    def test_client_works(self, redis):
+        self.assertEqual(client(), redis.Redis.from_url.return_value)
+        self.assertEqual(client(), redis.Redis.from_url.return_value)
+
+        redis.Redis.from_url.assert_called_once_with(
+            "redis://localhost:6379/0", socket_timeout=0.5, socket_connect_timeout=0.5
+        )
+
+    def test_client_requires_redis_url(self, redis):
+        with override_settings(REDIS_URL=None):
+            with self.assertRaises(Exception):
+                client()
+
+    def test_take_token_works(self, redis):
+        mock_client = redis.Redis.from_url.return_value
+        script = mock_client.register_script.return_value
+        script.return_value = 1
+
+        self.assertTrue(take_token("tb:foo", 20, 3600))
+        mock_client.register_script.assert_called_once_with(TAKE_TOKEN_LUA)
+        script.assert_called_once_with(keys=["tb:foo"], args=[20, 3600])
+
+    def test_take_token_handles_empty_bucket(self, redis):
+        mock_client = redis.Redis.from_url.return_value
+        mock_client.register_script.return_value.return_value = 0
+
+        self.assertFalse(take_token("tb:foo", 20, 3600))
+
+    def test_take_token_registers_script_once(self, redis):
+        mock_client = redis.Redis.from_url.return_value
+
+        take_token("tb:foo", 20, 3600)
+        take_token("tb:bar", 20, 3600)
+        self.assertEqual(mock_client.register_script.call_count, 1)
+
+    def test_add_key_works(self, redis):
+        mock_client = redis.Redis.from_url.return_value
+        mock_client.set.return_value = True
+
+        self.assertTrue(add_key("tb:foo", 90))
+        mock_client.set.assert_called_once_with("tb:foo", 1, nx=True, ex=90)
+
+    def test_add_key_handles_existing_key(self, redis):
+        # redis-py returns None when NX prevents the write
+        redis.Redis.from_url.return_value.set.return_value = None
+
+        self.assertFalse(add_key("tb:foo", 90))
@@ -0,0 +1,234 @@
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from threading import Thread
+from unittest.mock import Mock, patch
+
+from django.core.cache import cache
+from django.test import TestCase
+from django.test.utils import override_settings
+from urllib3 import PoolManager
+from urllib3.exceptions import HTTPError, MaxRetryError
+from urllib3.util.retry import Retry
+
+from hc.lib import s3
+from hc.lib.s3 import (
+    BodyCache,
+    _remove_objects,
+    client,
+    enc,
+    get_object,
+    put_object,
+    put_object_async,
+    remove_objects,
+)
+
+
+class MockS3Error(Exception):
+    def __init__(self, code):
+        self.code = code
+
+
+class S3TestCase(TestCase):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+
+    def test_enc_works(self):
+        self.assertEqual(enc(0), "zj-0")
+        self.assertEqual(enc(123), "xihg-123")
+        self.assertEqual(enc(1023), "wijhg-1023")
+        self.assertEqual(enc(1024), "wijhf-1024")
+        self.assertEqual(enc(99999), "vaaaaa-99999")
+
+    @patch("hc.lib.s3.put_object")
+    def test_put_object_async_works(self, put_object):
+        fallback = Mock()
+        put_object_async("code", 1, b"data", fallback=fallback).result()
+
+        put_object.assert_called_once_with("code", 1, b"data")
+        self.assertFalse(fallback.called)
+
+    @patch("hc.lib.s3.print", create=True)
+    @patch("hc.lib.s3.put_object")
+    def test_put_object_async_calls_fallback(self, put_object, mock_print):
+        put_object.side_effect = Exception("boom")
+
+        fallback = Mock()
+        put_object_async("code", 1, b"data", fallback=fallback).result()
+        self.assertTrue(fallback.called)
+
+    @override_settings(S3_BUCKET="test-bucket")
+    @patch("hc.lib.s3.DeleteObject", create=True)
+    @patch("hc.lib.s3.client")
+    def test_remove_objects_sends_batches(self, client, delete_object):
+        objs = [Mock(object_name="code/%s" % enc(i)) for i in range(2500)]
+        client.return_value.list_objects.return_value = iter(objs)
+        client.return_value.remove_objects.return_value = iter([])
+
+        _remove_objects("code", 2500)
+
+        args, kwargs = client.return_value.list_objects.call_args
+        self.assertEqual(args, ("test-bucket", "code/"))
+        self.assertEqual(kwargs["start_after"], "code/" + enc(2501))
+        self.assertTrue(kwargs["recursive"])
+
+        sizes = [len(c.args[1]) for c in client.return_value.remove_objects.mock_calls]
+        self.assertEqual(sorted(sizes), [500, 1000, 1000])
+
+    @override_settings(S3_BUCKET="test-bucket")
+    @patch("hc.lib.s3.DeleteObject", create=True)
+    @patch("hc.lib.s3.client")
+    def test_remove_objects_stops_at_other_prefix(self, client, delete_object):
+        objs = [Mock(object_name="code/zj-0"), Mock(object_name="code2/zj-0")]
+        client.return_value.list_objects.return_value = iter(objs)
+        client.return_value.remove_objects.return_value = iter([])
+
+        _remove_objects("code", 10)
+
+        delete_object.assert_called_once_with("code/zj-0")
+
+    @patch("hc.lib.s3._remove_objects")
+    def test_remove_objects_runs_in_background(self, mock_remove):
+        remove_objects("code", 10).result()
+
+        mock_remove.assert_called_once_with("code", 10)
+
+    @override_settings(S3_BUCKET="test-bucket")
+    @patch("hc.lib.s3.Retry", create=True)
+    @patch("hc.lib.s3.PoolManager", create=True)
+    @patch("hc.lib.s3.Minio", create=True)
+    @patch("hc.lib.s3._client", None)
+    def test_client_is_created_once(self, mock_minio, mock_pool, mock_retry):
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            clients = list(executor.map(lambda i: client(), range(8)))
+
+        self.assertEqual(mock_minio.call_count, 1)
+        self.assertTrue(all(c is s3._client for c in clients))
+
+    @patch("hc.lib.s3.Retry", Retry, create=True)
+    @patch("hc.lib.s3.PoolManager", PoolManager, create=True)
+    @patch("urllib3.util.retry.time.sleep")
+    def test_http_client_returns_last_server_error(self, sleep):
+        requests = []
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_PUT(self):
+                requests.append(self.path)
+                self.send_response(500)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        server = HTTPServer(("127.0.0.1", 0), Handler)
+        Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            url = "http://127.0.0.1:%d/bucket/key" % server.server_port
+            # Retries 3 times, then returns the response, for minio to
+            # turn into an S3Error
+            r = s3._http_client().request("PUT", url, body=b"data")
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        self.assertEqual(r.status, 500)
+        self.assertEqual(len(requests), 4)
+
+    @override_settings(S3_BUCKET="test-bucket")
+    @patch("hc.lib.s3.client")
+    def test_put_object_does_not_retry(self, client):
+        client.return_value.put_object.side_effect = MockS3Error("InternalError")
+
+        with self.assertRaises(MockS3Error):
+            put_object("code", 1, b"data")
+
+        self.assertEqual(client.return_value.put_object.call_count, 1)
+
+    @override_settings(S3_BUCKET="test-bucket")
+    @patch("hc.lib.s3._cache", BodyCache(max_bytes=1000))
+    @patch("hc.lib.s3.client")
+    def test_get_object_caches_body(self, client):
+        client.return_value.get_object.return_value.read.return_value = b"body"
+
+        self.assertEqual(get_object("code", 1), b"body")
+        self.assertEqual(get_object("code", 1), b"body")
+        self.assertEqual(client.return_value.get_object.call_count, 1)
+
+    @override_settings(S3_BUCKET="test-bucket")
+    @patch("hc.lib.s3._cache", BodyCache(max_bytes=1000))
+    @patch("hc.lib.s3.HTTPError", HTTPError, create=True)
+    @patch("hc.lib.s3.S3Error", MockS3Error, create=True)
+    @patch("hc.lib.s3.client")
+    def test_get_object_handles_unavailable_service(self, client):
+        error = MaxRetryError(None, "/bucket/key", "too many 500 error responses")
+        client.return_value.get_object.side_effect = error
+
+        self.assertIsNone(get_object("code", 1))
+
+    @override_settings(S3_BUCKET="test-bucket")
+    @patch("hc.lib.s3._cache", BodyCache(max_bytes=1000))
+    @patch("hc.lib.s3.HTTPError", HTTPError, create=True)
+    @patch("hc.lib.s3.S3Error", MockS3Error, create=True)
+    @patch("hc.lib.s3.client")
+    def test_get_object_does_not_cache_missing_object(self, client):
+        client.return_value.get_object.side_effect = MockS3Error("NoSuchKey")
+
+        self.assertIsNone(get_object("code", 1))
+        self.assertIsNone(get_object("code", 1))
+        self.assertEqual(client.return_value.get_object.call_count, 2)
+
+    def test_body_cache_evicts_least_recently_used(self):
+        cache = BodyCache(max_bytes=10)
+        cache.set("a", b"aaaa")
+        cache.set("b", b"bbbb")
+        cache.get("a")
+        cache.set("c", b"cccc")
+
+        self.assertEqual(cache.get("a"), b"aaaa")
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("c"), b"cccc")
+        self.assertEqual(cache.size, 8)
+
+    @patch("hc.lib.s3._remove_objects")
+    def test_remove_objects_skips_already_removed(self, mock_remove):
+        cache.set("s3:min_n:code", 10)
+
+        self.assertIsNone(remove_objects("code", 5))
+        self.assertIsNone(remove_objects("code", 10))
+        self.assertFalse(mock_remove.called)
+
+        remove_objects("code", 11).result()
+        mock_remove.assert_called_once_with("code", 11)
+
+    @override_settings(S3_BUCKET="test-bucket")
+    @patch("hc.lib.s3.DeleteObject", create=True)
+    @patch("hc.lib.s3.client")
+    def test_remove_objects_remembers_progress(self, client, delete_object):
+        client.return_value.list_objects.return_value = iter([])
+
+        _remove_objects("code", 10)
+        self.assertEqual(cache.get("s3:min_n:code"), 10)
+
+    @patch("hc.lib.s3._pending", {})
+    @patch("hc.lib.s3._remover")
+    @patch("hc.lib.s3._remove_objects")
+    def test_remove_objects_coalesces_queued_calls(self, mock_remove, remover):
+        remove_objects("code", 10)
+        self.assertIsNone(remove_objects("code", 20))
+        self.assertIsNone(remove_objects("code", 15))
+        self.assertEqual(remover.submit.call_count, 1)
+
+        # Run the queued job
+        fn, *args = remover.submit.call_args.args
+        fn(*args)
+        mock_remove.assert_called_once_with("code", 20)
+        self.assertEqual(s3._pending, {})
+
+    @patch("hc.lib.s3.print", create=True)
+    @patch("hc.lib.s3._remove_objects")
+    def test_remove_objects_reports_errors(self, mock_remove, mock_print):
+        mock_remove.side_effect = Exception("boom")
+
+        remove_objects("code", 10).result()
+        self.assertTrue(mock_print.called)
@@ -199,6 +199,12 @@ S3_REGION = os.getenv("S3_REGION")
 S3_BUCKET = os.getenv("S3_BUCKET")
 S3_TIMEOUT = envint("S3_TIMEOUT", 60)
 
+# Redis connection URL for storing rate limiting token buckets.
+# (Optional. If not specified, will store token buckets in the database.
+# Requires the redis Python package, and Redis 5.0 or later. If Redis is
+# unreachable, rate limiting falls back to the database.)
+REDIS_URL = os.getenv("REDIS_URL")
+
 # Integrations
 
 # Apprise